@@ -1,14 +1,31 @@
-import collections
-import collections.abc
-collections.Iterable = collections.abc.Iterable  # Compat. savReaderWriter en Python 3.10+
-
 import streamlit as st
-from savReaderWriter import SavReader
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyreadstat  # lector en C (readstat), reemplazo de savReaderWriter
 from io import BytesIO
+from xml.sax.saxutils import escape as xml_escape
+import datetime as dt
+import hashlib
+import itertools
+import math
+import re
+import zipfile
 from pathlib import Path
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import time
 import tempfile
-from typing import Dict, Any, List, Tuple
-import xlsxwriter  # reemplazo de openpyxl
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 # ======================
 # Traducciones
@@ -21,13 +38,25 @@ TEXTS = {
         "load_status": "Cargando archivo SPSS…",
         "success_load": "Archivo cargado correctamente ✅",
         "error_load": "Error al cargar archivo",
-        "file_info": "**Archivo:** {name}  •  **Filas:** {rows:,}  •  **Columnas:** {cols}",
+        "file_info": "**Archivo:** {name}  •  **Filas:** {rows}  •  **Columnas:** {cols}",
         "download": "💾 Descargar como Excel (.xlsx)",
-        "saving": "Generando Excel…",
-        "success_save": "Excel generado ✅",
+        "download_parquet": "📦 Descargar como Parquet (más rápido, sin límite de filas)",
+        "excel_limit": "⚠️ Excel admite como máximo {max:,} filas: el .xlsx se truncará. Usa Parquet para el archivo completo.",
         "toggle_lang": "🌐 English",
+        "fast_excel": "⚡ Excel rápido (sin comprimir)",
+        "fast_excel_help": "Rápido: el .xlsx se guarda sin comprimir, se genera antes pero pesa varias veces más. "
+                           "Desactivado: compresión ligera, archivo más pequeño.",
+        "inline_strings": "🔡 Textos dentro de cada celda",
+        "inline_strings_help": "Sin tabla de textos compartidos: para lectores que procesan la hoja en streaming. "
+                               "Desactivado: la tabla se usa si los textos se repiten mucho (más rápido y pequeño).",
+        "encoding": "🔤 Codificación de textos",
+        "encoding_help": "Automática: la que declara el archivo. Los archivos SPSS antiguos suelen estar en "
+                         "Windows-1252; si faltan tildes o eñes, elígela aquí.",
+        "encoding_auto": "Automática",
         "tips": "💡 Consejo: si tu archivo tiene muchas filas, la descarga puede tomar algunos segundos.",
         "no_file": "Sube un archivo para comenzar",
+        "preview": "👀 Vista previa",
+        "preview_rows": "Filas en la vista previa",
         "sheetname": "Datos"
     },
     "en": {
@@ -37,13 +66,25 @@ TEXTS = {
         "load_status": "Loading SPSS file…",
         "success_load": "File loaded successfully ✅",
         "error_load": "Error loading file",
-        "file_info": "**File:** {name}  •  **Rows:** {rows:,}  •  **Columns:** {cols}",
+        "file_info": "**File:** {name}  •  **Rows:** {rows}  •  **Columns:** {cols}",
         "download": "💾 Download as Excel (.xlsx)",
-        "saving": "Generating Excel…",
-        "success_save": "Excel generated ✅",
+        "download_parquet": "📦 Download as Parquet (faster, no row limit)",
+        "excel_limit": "⚠️ Excel holds at most {max:,} rows: the .xlsx will be truncated. Use Parquet for the full file.",
         "toggle_lang": "🌐 Español",
+        "fast_excel": "⚡ Fast Excel (uncompressed)",
+        "fast_excel_help": "Fast: the .xlsx is stored uncompressed, it is generated sooner but is several times larger. "
+                           "Off: light compression, smaller file.",
+        "inline_strings": "🔡 Text inside each cell",
+        "inline_strings_help": "No shared-strings table: for readers that process the sheet as a stream. "
+                               "Off: the table is used when texts repeat a lot (faster and smaller).",
+        "encoding": "🔤 Text encoding",
+        "encoding_help": "Automatic: the one declared by the file. Old SPSS files are usually Windows-1252; "
+                         "pick it here if accented characters go missing.",
+        "encoding_auto": "Automatic",
         "tips": "💡 Tip: if your file is large, generating the download can take some seconds.",
         "no_file": "Upload a file to get started",
+        "preview": "👀 Preview",
+        "preview_rows": "Rows in preview",
         "sheetname": "Data"
     },
 }
@@ -52,87 +93,718 @@ TEXTS = {
 # Helpers principales
 # ======================
 
-def decode_bytes(x: Any) -> Any:
-    if isinstance(x, bytes):
-        return x.decode("utf-8", errors="ignore")
-    return x
+CHUNK_SIZE = 50_000  # filas por bloque al leer el SAV
+COMPRESSED_CHUNK_CELLS = 10_000_000  # celdas por bloque en SAV comprimidos (ver iter_sav)
+MAX_DENSE_CODE = 1_000_000  # códigos mayores: tabla densa demasiado grande, se usa index_in
+PARALLEL_MIN_ROWS = 2 * CHUNK_SIZE  # por debajo no hay bloques que repartir: arrancar procesos no compensa
+SHM_DIR = "/dev/shm"  # tmpfs en Linux: el archivo temporal vive en RAM, sin escritura a disco
+CACHE_DIR = Path(tempfile.gettempdir()) / "spss2excel_cache"  # tablas ya etiquetadas, en formato Arrow IPC
+CACHE_TTL = 24 * 3600  # segundos que se conserva una tabla cacheada sin usar
+CACHE_MAX_BYTES = 2 << 30  # tamaño total de la caché en disco; por encima se borran las menos usadas (LRU)
+CACHE_TMP_TTL = 3600  # segundos sin escribir tras los que un .tmp se da por abandonado (proceso caído)
+CACHE_FORMAT = 3  # cambia cuando cambia la forma de las tablas guardadas (3: tipos según los metadatos)
+# Codificaciones que se pueden forzar (nombres de iconv). readstat descarta en silencio los bytes que no
+# puede convertir con la declarada; las de un solo byte asignan un carácter a cada byte y nunca pierden nada.
+ENCODINGS = [None, "UTF-8", "WINDOWS-1252", "LATIN1"]
+LABEL_CODE, LABEL_TEXT = "code", "label"  # campos de las columnas etiquetadas (struct)
+# Formatos SPSS que pyreadstat convierte a fecha, fecha y hora u hora
+SPSS_DATE_FORMATS = {"DATE", "ADATE", "EDATE", "JDATE", "SDATE"}
+SPSS_DATETIME_FORMATS = {"DATETIME", "YMDHMS"}
+SPSS_TIME_FORMATS = {"TIME", "DTIME"}
+
+
+def dense_label_table(mapping: Dict[Any, str]) -> Optional[np.ndarray]:
+    """Tabla etiqueta-por-código (índice = código) si todos los códigos son enteros en [0, MAX_DENSE_CODE]; si no, None."""
+    codes = list(mapping)
+    if not all(isinstance(c, (int, float)) and float(c).is_integer() and 0 <= c <= MAX_DENSE_CODE for c in codes):
+        return None
+    table = np.full(int(max(codes)) + 1, None, dtype=object)
+    for code, label in mapping.items():
+        table[int(code)] = label
+    return table
+
+
+class ColumnLabels(NamedTuple):
+    """Etiquetas de valores de una columna, ya convertidas a arrays de Arrow."""
+    dense: Optional[pa.Array]  # etiqueta por código (índice = código) si los códigos son enteros pequeños
+    codes: pa.Array  # códigos con etiqueta, para index_in
+    labels: pa.Array  # etiquetas, en el mismo orden que codes
+
+
+def prepare_labels(
+    column_names: List[str], value_labels: Dict[str, Dict[Any, str]]
+) -> List[Optional[ColumnLabels]]:
+    """Etiquetas por posición de columna (None si no tiene), resueltas una vez por archivo y no en cada bloque."""
+    col_labels: List[Optional[ColumnLabels]] = []
+    for name in column_names:
+        mapping = value_labels.get(name)
+        if not mapping:
+            col_labels.append(None)
+            continue
+        table = dense_label_table(mapping)
+        col_labels.append(ColumnLabels(
+            dense=pa.array(table, type=pa.string()) if table is not None else None,
+            codes=pa.array(list(mapping)),
+            labels=pa.array(list(mapping.values()), type=pa.string()),
+        ))
+    return col_labels
+
+
+def label_column(codes: pa.ChunkedArray, col_labels: ColumnLabels) -> pa.StructArray:
+    """Etiqueta una columna con kernels de Arrow (en C).
+
+    Devuelve struct<code, label>: el código original con su tipo nativo y su etiqueta (null si no tiene).
+    Así cada salida decide: Excel escribe la etiqueta o el código numérico celda a celda, mientras que
+    Parquet (un solo tipo por columna) los pasa a texto con labels_as_text.
+    """
+    codes = codes.combine_chunks()
+    no_labels = pa.nulls(len(codes), pa.string())
+    numeric = pa.types.is_floating(codes.type) or pa.types.is_integer(codes.type)
+    if numeric and col_labels.dense is not None:
+        # Códigos enteros: el índice en la tabla densa es el propio código (sin hashing)
+        values = codes.to_numpy(zero_copy_only=False).astype(np.float64)
+        in_range = (values >= 0) & (values < len(col_labels.dense)) & (values == np.floor(values))  # NaN queda fuera
+        if not in_range.any():
+            return labelled_struct(codes, no_labels)
+        indices = pa.array(np.where(in_range, values, 0).astype(np.int64), mask=~in_range)
+        labels = pc.take(col_labels.dense, indices)
+    else:
+        indices = pc.index_in(codes, value_set=col_labels.codes.cast(codes.type))
+        if indices.null_count == len(indices):
+            return labelled_struct(codes, no_labels)
+        labels = pc.take(col_labels.labels, indices)
+    return labelled_struct(codes, labels)
+
+
+def labelled_struct(codes: pa.Array, labels: pa.Array) -> pa.StructArray:
+    return pa.StructArray.from_arrays([codes, labels], names=[LABEL_CODE, LABEL_TEXT])
+
+
+def labels_as_text(col: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Columna etiquetada → texto: la etiqueta o, si no tiene, el código ("3", no "3.0")."""
+    codes = pc.struct_field(col, [0])
+    return pc.coalesce(pc.struct_field(col, [1]), pc.cast(codes, pa.string()))
+
+
+def used_labels(tables: Iterable[pa.Table]) -> set:
+    """Posiciones de las columnas etiquetadas con al menos un código etiquetado en todo el archivo."""
+    used = set()
+    for table in tables:
+        for i, col in enumerate(table.columns):
+            if pa.types.is_struct(col.type) and pc.struct_field(col, [1]).null_count < len(col):
+                used.add(i)
+    return used
+
+
+def flatten_labels(table: pa.Table, used: set) -> pa.Table:
+    """Columnas etiquetadas (struct) con un solo tipo, para las salidas que lo exigen.
+
+    Se decide por archivo (used): las que usan alguna etiqueta pasan a texto; las que declaran etiquetas pero
+    nunca las usan conservan el código con su tipo nativo.
+    """
+    columns = [
+        (labels_as_text(col) if i in used else pc.struct_field(col, [0])) if pa.types.is_struct(col.type) else col
+        for i, col in enumerate(table.columns)
+    ]
+    return pa.Table.from_arrays(columns, names=table.column_names)
+
+
+def excel_values(col: pa.ChunkedArray) -> List[Any]:
+    """Valores de una columna para Excel: en las etiquetadas, la etiqueta o el código con su tipo (números siguen
+    siendo números, SUMA/PROMEDIO funcionan)."""
+    if not pa.types.is_struct(col.type):
+        return col.to_pylist()
+    codes = pc.struct_field(col, [0]).to_pylist()
+    labels = pc.struct_field(col, [1]).to_pylist()
+    return [code if label is None else label for code, label in zip(codes, labels)]
+
+
+def sav_type(var_format: str, readstat_type: str) -> pa.DataType:
+    """Tipo Arrow de una variable según su formato SPSS (los mismos grupos que usa pyreadstat para convertir)."""
+    if readstat_type == "string":
+        return pa.string()
+    name = re.match(r"[A-Z]*", var_format.upper()).group()
+    if name in SPSS_DATE_FORMATS:
+        return pa.date32()
+    if name in SPSS_DATETIME_FORMATS:
+        return pa.timestamp("us")
+    if name in SPSS_TIME_FORMATS:
+        return pa.time64("us")
+    return pa.float64()
+
+
+def sav_schema(meta: Any) -> pa.Schema:
+    """Esquema de todos los bloques, tomado de los metadatos y no del primer bloque.
+
+    Inferido del primer bloque, una columna de fechas vacía en sus primeras filas quedaba como null y el
+    resto del archivo se convertía a texto.
+    """
+    return pa.schema([
+        (name, sav_type(meta.original_variable_types[name], meta.readstat_variable_types[name]))
+        for name in meta.column_names
+    ])
+
+
+def to_arrow(df: pd.DataFrame, col_labels: List[Optional[ColumnLabels]], schema: pa.Schema) -> pa.Table:
+    """Bloque de pyreadstat → pa.Table columnar (NaN/NaT como nulos) con las etiquetas de valores aplicadas.
+
+    col_labels va por posición de columna (ver prepare_labels): ni búsquedas por nombre ni tablas por bloque.
+    schema (ver sav_schema) fija los tipos; safe=False solo trunca fechas con más precisión que microsegundos.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False).cast(schema, safe=False)
+    columns = [
+        label_column(col, labels) if labels is not None else col
+        for col, labels in zip(table.columns, col_labels)
+    ]
+    return pa.Table.from_arrays(columns, names=table.column_names)
+
+
+def file_digest(file_bytes: bytes) -> str:
+    """Huella blake2b del contenido completo del archivo; es la clave de caché en lugar de los bytes.
+
+    st.cache_data y la caché en disco se comparten entre sesiones: una clave muestreada podría servir a un
+    usuario el libro de otro. Se calcula una vez por archivo subido (ver upload_digest).
+    """
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+
+def upload_digest(uploaded: Any) -> str:
+    """file_digest del archivo subido, memorizado en la sesión: los reruns no vuelven a hashear los bytes."""
+    digests = st.session_state.setdefault("file_digests", {})
+    if uploaded.file_id not in digests:
+        digests.clear()
+        digests[uploaded.file_id] = file_digest(uploaded.getvalue())
+    return digests[uploaded.file_id]
+
+
+def temp_dir_for(size: int) -> Optional[str]:
+    """/dev/shm (tmpfs, en RAM) si existe y tiene espacio; si no, el directorio temporal por defecto."""
+    if os.path.isdir(SHM_DIR) and shutil.disk_usage(SHM_DIR).free > size:
+        return SHM_DIR
+    return None
+
+
+@contextmanager
+def temp_sav(file_bytes: bytes) -> Iterator[str]:
+    """Escribe los bytes subidos a un archivo temporal (pyreadstat lee desde una ruta) y lo borra al salir."""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".sav", dir=temp_dir_for(len(file_bytes))) as tmp:
+        tmp.write(file_bytes)
+    try:
+        yield tmp.name
+    finally:
+        os.unlink(tmp.name)
+
+
+def sav_headers(meta: Any) -> List[str]:
+    """Headers finales: nombre de variable con su etiqueta, si la tiene."""
+    final_headers: List[str] = []
+    for var_name, label in zip(meta.column_names, meta.column_labels):
+        label = (label or "").strip()
+        final_headers.append(f"{var_name} ({label})" if label else var_name)
+    return final_headers
+
 
 @st.cache_data(show_spinner=False)
-def process_sav(file_bytes: bytes) -> Tuple[List[List[Any]], List[str]]:
-    """Procesa el SAV con SavReader, aplica etiquetas de variables/valores y retorna (rows, headers)."""
-    # Escribir bytes a un archivo temporal
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".sav") as tmp:
-        tmp.write(file_bytes)
-        tmp_path = tmp.name
+def read_sav_metadata(file_hash: str, encoding: Optional[str], _file_bytes: bytes) -> Tuple[List[str], int]:
+    """Lee solo los metadatos del SAV (sin datos) y retorna (headers, número de filas).
 
-    with SavReader(tmp_path, returnHeader=True, rawMode=False) as reader:
-        header = reader.header
-        varLabels = reader.varLabels
-        valueLabels = reader.valueLabels
-        records = reader.all()
+    Streamlit no hashea los argumentos con prefijo "_": la caché se indexa solo por file_hash.
+    """
+    with temp_sav(_file_bytes) as path:
+        _, meta = pyreadstat.read_sav(path, metadataonly=True, encoding=encoding)
+    return sav_headers(meta), meta.number_rows
 
-    headers_dict = {i: decode_bytes(h) for i, h in enumerate(header)}
 
-    var_labels_dict: Dict[str, str] = {
-        decode_bytes(k): decode_bytes(v) for k, v in varLabels.items()
-    } if varLabels else {}
+@st.cache_data(show_spinner=False)
+def read_sav_preview(file_hash: str, n_rows: int, encoding: Optional[str], _file_bytes: bytes) -> pa.Table:
+    """Lee solo las primeras n_rows filas, con etiquetas de valores, para la vista previa."""
+    with temp_sav(_file_bytes) as path:
+        df, meta = pyreadstat.read_sav(path, row_limit=n_rows, encoding=encoding, disable_datetime_conversion=False)
+    col_labels = prepare_labels(meta.column_names, meta.variable_value_labels)
+    table = to_arrow(df, col_labels, sav_schema(meta))
+    return flatten_labels(table, used_labels([table])).rename_columns(sav_headers(meta))
 
-    value_labels_dict: Dict[str, Dict[Any, str]] = {}
-    if valueLabels:
-        for var_key, val_dict in valueLabels.items():
-            var_key_str = decode_bytes(var_key)
-            value_labels_dict[var_key_str] = {
-                val_code: decode_bytes(val_label) for val_code, val_label in val_dict.items()
-            }
 
-    # Headers finales con etiqueta
-    final_headers: List[str] = []
-    for i in range(len(headers_dict)):
-        var_name = headers_dict[i]
-        label = var_labels_dict.get(var_name, "").strip()
-        final_headers.append(f"{var_name} ({label})" if label else var_name)
+# Etiquetas de valores y esquema de cada proceso worker: se envían una sola vez, en el initializer
+_worker_col_labels: List[Optional[ColumnLabels]] = []
+_worker_schema: Optional[pa.Schema] = None
 
-    # Filas con etiquetas aplicadas
-    rows: List[List[Any]] = []
-    for idx, record in enumerate(records):
-        if idx == 0:
+
+def _init_worker(col_labels: List[Optional[ColumnLabels]], schema: pa.Schema) -> None:
+    global _worker_col_labels, _worker_schema
+    _worker_col_labels = col_labels
+    _worker_schema = schema
+
+
+def _read_chunk(path: str, offset: int, limit: int, encoding: Optional[str]) -> pa.Table:
+    """Worker: lee y etiqueta las filas [offset, offset + limit) del SAV."""
+    df, _ = pyreadstat.read_sav(
+        path, row_offset=offset, row_limit=limit, encoding=encoding, disable_datetime_conversion=False
+    )
+    return to_arrow(df, _worker_col_labels, _worker_schema)
+
+
+def sav_compressed(path: str) -> bool:
+    """¿El SAV está comprimido (bytecode o zlib)? Lo dice el campo compression de la cabecera."""
+    with open(path, "rb") as f:
+        header = f.read(76)
+    if len(header) < 76:
+        return False
+    # layout_code (2 o 3) indica el orden de bytes con que se escribió el archivo
+    order = "<" if struct.unpack_from("<i", header, 64)[0] in (2, 3) else ">"
+    return struct.unpack_from(order + "i", header, 72)[0] != 0
+
+
+def iter_sav(path: str, encoding: Optional[str] = None, chunksize: int = CHUNK_SIZE) -> Iterator[pa.Table]:
+    """Lee el SAV por bloques de filas y entrega cada bloque, en orden, como pa.Table con las etiquetas aplicadas.
+
+    Con archivos grandes los bloques se leen y etiquetan en paralelo en un pool de procesos (fuera del GIL).
+    Los textos los decodifica readstat en C con la codificación del archivo, o con encoding si se indica.
+
+    Cada bloque se lee con row_offset, y en un SAV comprimido (el formato por defecto de SPSS) readstat
+    descomprime desde el inicio para llegar al offset: el coste total crece con el cuadrado de las filas
+    (1M×10 zlib: 6.4 s en bloques de 50k frente a 2.6 s de una lectura). Por eso estos archivos se leen en
+    secuencia y en bloques de COMPRESSED_CHUNK_CELLS celdas: a cambio de más memoria por bloque, un archivo
+    mediano se lee de una vez y uno grande en pocos bloques.
+    """
+    _, meta = pyreadstat.read_sav(path, metadataonly=True, encoding=encoding)
+    n_rows = meta.number_rows
+    col_labels = prepare_labels(meta.column_names, meta.variable_value_labels)
+    schema = sav_schema(meta)
+    # Los workers se crean con fork: el script de Streamlit no es importable desde un proceso nuevo. En macOS
+    # fork no es seguro (las librerías del sistema pueden colgarse en el hijo), así que solo se usa en Linux.
+    # Aun en Linux el servidor de Streamlit tiene varios hilos (tornado, pools de Arrow): si otro hilo tiene un
+    # lock tomado en el momento del fork, el hijo lo hereda tomado y puede bloquearse al pedirlo. Se acepta
+    # porque el hijo solo usa readstat (sin hilos) y Arrow, cuyo allocator y pools se reinician tras fork
+    # (pthread_atfork); Python ≥ 3.12 lo avisa con un DeprecationWarning. Con un solo worker el pool es más
+    # lento que leer en el proceso principal.
+    n_workers = os.cpu_count() or 1
+    use_pool = sys.platform.startswith("linux") and n_workers >= 2
+    if sav_compressed(path):
+        use_pool = False
+        chunksize = max(chunksize, COMPRESSED_CHUNK_CELLS // max(1, meta.number_columns))
+    if not use_pool or n_rows is None or n_rows < PARALLEL_MIN_ROWS:
+        for df, _ in pyreadstat.read_file_in_chunks(
+            pyreadstat.read_sav, path, chunksize=chunksize, encoding=encoding, disable_datetime_conversion=False
+        ):
+            yield to_arrow(df, col_labels, schema)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(col_labels, schema),
+    ) as executor:
+        # Ventana acotada de bloques en vuelo para no acumular en memoria lo que el escritor aún no consumió
+        pending = deque()
+        for offset in range(0, n_rows, chunksize):
+            pending.append(executor.submit(_read_chunk, path, offset, chunksize, encoding))
+            if len(pending) > 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def disk_cache_key(file_hash: str, encoding: Optional[str]) -> str:
+    """Clave de la caché en disco: file_digest más la codificación de lectura y el formato de la caché."""
+    return f"{file_hash}-{encoding or 'auto'}-v{CACHE_FORMAT}"
+
+
+def prune_cache(keep: Optional[Path] = None) -> None:
+    """Limpia la caché en disco.
+
+    Borra los .tmp abandonados, las tablas sin usar desde hace más de CACHE_TTL y, si aun así se supera
+    CACHE_MAX_BYTES, las menos usadas recientemente (cada acierto actualiza el mtime). keep nunca se borra:
+    es la tabla recién escrita, que se vuelve a leer enseguida aunque sola supere el límite.
+    """
+    now = time.time()
+    entries = []
+    for entry in CACHE_DIR.iterdir():
+        try:
+            stat = entry.stat()
+            if entry.suffix == ".tmp":
+                if stat.st_mtime < now - CACHE_TMP_TTL:
+                    entry.unlink()
+            elif entry.suffix == ".arrow":
+                if stat.st_mtime < now - CACHE_TTL:
+                    entry.unlink()
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry))
+        except OSError:
+            pass
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        if entry == keep:
             continue
-        row = []
-        for col_idx, val in enumerate(record):
-            var_name = headers_dict[col_idx]
-            labels_for_var = value_labels_dict.get(var_name)
-            if labels_for_var is not None and val in labels_for_var:
-                row.append(labels_for_var[val])
-            else:
-                row.append(decode_bytes(val))
-        rows.append(row)
+        try:
+            entry.unlink()
+        except OSError:
+            pass
+        total -= size
+
+
+def iter_labelled(cache_key: str, encoding: Optional[str], file_bytes: bytes) -> Iterator[pa.Table]:
+    """Bloques etiquetados del SAV, servidos desde la caché en disco si ya se procesó este archivo.
+
+    La primera vez se parsea el SAV y cada bloque se guarda en un archivo Arrow IPC mientras se entrega;
+    las siguientes se abre con memory-map: sin parsear ni copiar, el sistema operativo sirve las páginas.
+    Así st.cache_data solo guarda datos pequeños, no el conjunto de datos completo. cache_key viene de
+    disk_cache_key.
+    """
+    cache_path = CACHE_DIR / f"{cache_key}.arrow"
+    # Otra sesión puede borrar la tabla (prune_cache) en cualquier momento: si ya no está, se reconstruye.
+    # Una vez mapeada, borrarla no afecta a la lectura.
+    try:
+        os.utime(cache_path)
+        source = pa.memory_map(str(cache_path))
+    except FileNotFoundError:
+        source = None
+    if source is not None:
+        with source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield pa.Table.from_batches([reader.get_batch(i)])
+        return
 
-    return rows, final_headers
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    prune_cache()
+    # Se escribe a un archivo propio y se renombra al final: una lectura a medias nunca queda como caché válida
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+    try:
+        writer: Optional[pa.ipc.RecordBatchFileWriter] = None
+        with temp_sav(file_bytes) as path:
+            for table in iter_sav(path, encoding):
+                if writer is None:
+                    writer = pa.ipc.new_file(str(tmp_path), table.schema)
+                writer.write_table(table)
+                yield table
+        if writer is not None:
+            writer.close()
+            os.replace(tmp_path, cache_path)
+            prune_cache(keep=cache_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
 
-def to_excel_bytes(headers: List[str], rows: List[List[Any]], sheet_name: str) -> bytes:
-    """Convierte a Excel usando XlsxWriter (más rápido y ligero que openpyxl)."""
+# ======================
+# Escritor XLSX mínimo
+# ======================
+# El XML de la hoja se emite directamente dentro del ZIP, sin librería: solo formateo de texto + compresión.
+
+EXCEL_MAX_ROWS = 1_048_576
+SST_MIN_REPEAT = 0.3  # tabla de strings compartidos solo si más del 30% de los textos se repiten
+SST_SAMPLE_SIZE = 10_000  # celdas de texto muestreadas del primer bloque para decidirlo, repartidas entre columnas
+SST_MAX_UNIQUE = 1_000_000  # textos distintos en la tabla compartida; los siguientes van inline
+
+XLSX_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PKG_REL_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+ROOT_RELS_XML = (
+    f'{XML_DECL}<Relationships xmlns="{PKG_REL_NS}">'
+    f'<Relationship Id="rId1" Type="{REL_NS}/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+).encode()
+
+STYLES_XML = (
+    f'{XML_DECL}<styleSheet xmlns="{XLSX_NS}">'
+    '<numFmts count="3"><numFmt numFmtId="164" formatCode="yyyy-mm-dd"/>'
+    '<numFmt numFmtId="165" formatCode="hh:mm:ss"/>'
+    '<numFmt numFmtId="166" formatCode="yyyy-mm-dd hh:mm:ss"/></numFmts>'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/><family val="2"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="4"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="166" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+).encode()
+
+STYLE_DATE = 1  # índices en cellXfs
+STYLE_TIME = 2
+STYLE_DATETIME = 3
+
+EXCEL_EPOCH = dt.datetime(1899, 12, 30)
+ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+def content_types_xml(shared_strings: bool) -> bytes:
+    sst = (
+        '<Override PartName="/xl/sharedStrings.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+        if shared_strings else ""
+    )
+    return (
+        f'{XML_DECL}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        f'{sst}</Types>'
+    ).encode()
+
+
+def workbook_xml(sheet_name: str) -> bytes:
+    name = xml_escape(sheet_name[:31], {'"': "&quot;"})
+    return (
+        f'{XML_DECL}<workbook xmlns="{XLSX_NS}" xmlns:r="{REL_NS}">'
+        f'<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ).encode()
+
+
+def workbook_rels_xml(shared_strings: bool) -> bytes:
+    sst = f'<Relationship Id="rId3" Type="{REL_NS}/sharedStrings" Target="sharedStrings.xml"/>' if shared_strings else ""
+    return (
+        f'{XML_DECL}<Relationships xmlns="{PKG_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{REL_NS}/worksheet" Target="worksheets/sheet1.xml"/>'
+        f'<Relationship Id="rId2" Type="{REL_NS}/styles" Target="styles.xml"/>'
+        f'{sst}</Relationships>'
+    ).encode()
+
+
+def column_letter(idx: int) -> str:
+    """0 → A, 25 → Z, 26 → AA…"""
+    letters = ""
+    idx += 1
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def xml_text(value: str) -> str:
+    """Texto apto para XML: sin caracteres de control ilegales, escapado y dentro del límite de Excel."""
+    return xml_escape(ILLEGAL_XML_CHARS.sub("", value[:32767]))
+
+
+class SharedStrings:
+    """Tabla de strings compartidos (xl/sharedStrings.xml): cada texto distinto se guarda una vez.
+
+    Acotada a SST_MAX_UNIQUE textos distintos: llena, add devuelve None y la celda se escribe inline.
+    """
+
+    def __init__(self) -> None:
+        self.index: Dict[str, int] = {}
+        self.count = 0
+
+    def add(self, value: str) -> Optional[int]:
+        idx = self.index.get(value)
+        if idx is None:
+            if len(self.index) >= SST_MAX_UNIQUE:
+                return None
+            idx = self.index[value] = len(self.index)
+        self.count += 1
+        return idx
+
+    def write_xml(self, stream, batch: int = 10_000) -> None:
+        """Escribe sharedStrings.xml en stream por tandas, sin armar el XML completo en memoria."""
+        stream.write(f'{XML_DECL}<sst xmlns="{XLSX_NS}" count="{self.count}" uniqueCount="{len(self.index)}">'.encode())
+        values = iter(self.index)
+        while True:
+            items = "".join(
+                f'<si><t xml:space="preserve">{xml_text(v)}</t></si>' for v in itertools.islice(values, batch)
+            )
+            if not items:
+                break
+            stream.write(items.encode())
+        stream.write(b"</sst>")
+
+
+def cell_xml(ref: str, value: Any, sst: Optional[SharedStrings]) -> str:
+    """XML de una celda; "" para vacías (None/inf)."""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        idx = sst.add(value) if sst is not None else None
+        if idx is not None:
+            return f'<c r="{ref}" t="s"><v>{idx}</v></c>'
+        return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{xml_text(value)}</t></is></c>'
+    if isinstance(value, (bool, np.bool_)):
+        return f'<c r="{ref}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, np.number)):
+        return f'<c r="{ref}"><v>{value!r}</v></c>' if math.isfinite(value) else ""
+    if isinstance(value, dt.datetime):
+        serial = (value.replace(tzinfo=None) - EXCEL_EPOCH).total_seconds() / 86400
+        return f'<c r="{ref}" s="{STYLE_DATETIME}"><v>{serial!r}</v></c>'
+    if isinstance(value, dt.date):
+        return f'<c r="{ref}" s="{STYLE_DATE}"><v>{(value - EXCEL_EPOCH.date()).days}</v></c>'
+    if isinstance(value, dt.time):
+        serial = (value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6) / 86400
+        return f'<c r="{ref}" s="{STYLE_TIME}"><v>{serial!r}</v></c>'
+    return cell_xml(ref, str(value), sst)
+
+
+def use_shared_strings(chunk: pa.Table) -> bool:
+    """Muestrea los textos del bloque: ¿se repiten lo suficiente como para compensar la tabla compartida?
+
+    Cada columna de texto (o etiquetada) aporta SST_SAMPLE_SIZE / n valores, así una primera columna de textos
+    únicos no decide por todas; las repeticiones se cuentan dentro de cada columna.
+    """
+    text_cols = [
+        col for col in chunk.columns
+        if pa.types.is_string(col.type) or pa.types.is_large_string(col.type) or pa.types.is_struct(col.type)
+    ]
+    if not text_cols:
+        return False
+    per_col = max(1, SST_SAMPLE_SIZE // len(text_cols))
+    total = repeated = 0
+    for col in text_cols:
+        sample = [v for v in excel_values(col.slice(0, per_col)) if isinstance(v, str)]
+        total += len(sample)
+        repeated += len(sample) - len(set(sample))
+    return total > 0 and repeated / total > SST_MIN_REPEAT
+
+
+def to_excel_bytes(
+    headers: List[str],
+    chunks: Iterable[pa.Table],
+    sheet_name: str,
+    compress: bool = True,
+    use_inline_strings: bool = False,
+) -> bytes:
+    """Convierte a XLSX escribiendo el XML de la hoja directamente en el ZIP, bloque a bloque.
+
+    Nunca se tiene el conjunto de datos completo en memoria; las filas por encima del límite de Excel se omiten.
+    Con compress=False el ZIP se guarda sin comprimir (ZIP_STORED): más rápido, archivo mucho más grande.
+    Con use_inline_strings=True los textos van siempre dentro de cada celda, sin tabla de strings compartidos.
+    Por defecto la tabla compartida se usa solo si el muestreo del primer bloque indica muchas repeticiones:
+    en este escritor (sin el hashing extra de una librería) acorta el XML y resulta más rápida que inline.
+    """
     output = BytesIO()
-    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-    worksheet = workbook.add_worksheet(sheet_name)
+    refs = [column_letter(i) for i in range(len(headers))]
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    shared = not use_inline_strings and first is not None and use_shared_strings(first)
+    sst = SharedStrings() if shared else None
+
+    # Nivel de compresión 1: ~2× más rápido que el nivel por defecto a costa de un archivo algo más grande
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zipfile.ZipFile(output, "w", compression=compression, compresslevel=1) as zf:
+        zf.writestr("[Content_Types].xml", content_types_xml(sst is not None))
+        zf.writestr("_rels/.rels", ROOT_RELS_XML)
+        zf.writestr("xl/workbook.xml", workbook_xml(sheet_name))
+        zf.writestr("xl/_rels/workbook.xml.rels", workbook_rels_xml(sst is not None))
+        zf.writestr("xl/styles.xml", STYLES_XML)
+
+        with zf.open("xl/worksheets/sheet1.xml", "w") as sheet:
+            sheet.write(f'{XML_DECL}<worksheet xmlns="{XLSX_NS}"><sheetData>'.encode())
+            header_cells = "".join(cell_xml(f"{ref}1", h, None) for ref, h in zip(refs, headers))
+            sheet.write(f'<row r="1">{header_cells}</row>'.encode())
+
+            row_idx = 1
+            for chunk in itertools.chain([first] if first is not None else [], chunks):
+                chunk = chunk.slice(0, EXCEL_MAX_ROWS - row_idx)
+                # Cada columna se convierte de una vez (en C); el XML se arma por filas
+                columns = [excel_values(col) for col in chunk.columns]
+                parts = []
+                for row in zip(*columns):
+                    row_idx += 1
+                    r = str(row_idx)
+                    cells = "".join([cell_xml(ref + r, val, sst) for ref, val in zip(refs, row)])
+                    parts.append(f'<row r="{r}">{cells}</row>')
+                sheet.write("".join(parts).encode())
+            sheet.write(b"</sheetData></worksheet>")
+
+        # Los strings compartidos solo se conocen al terminar la hoja
+        if sst is not None:
+            with zf.open("xl/sharedStrings.xml", "w") as stream:
+                sst.write_xml(stream)
 
-    # Escribir encabezados
-    for col, h in enumerate(headers):
-        worksheet.write(0, col, h)
+    return output.getvalue()
 
-    # Escribir filas
-    for row_idx, row in enumerate(rows, start=1):
-        for col_idx, val in enumerate(row):
-            worksheet.write(row_idx, col_idx, val)
 
-    workbook.close()
-    output.seek(0)
-    return output.getvalue()
+def to_parquet_bytes(headers: List[str], chunks: Callable[[], Iterable[pa.Table]]) -> bytes:
+    """Convierte a Parquet (Snappy + diccionario) escribiendo un row group por bloque.
+
+    chunks se recorre dos veces: la primera decide qué columnas etiquetadas pasan a texto (used_labels), la
+    segunda escribe. Con la caché en disco de iter_labelled la segunda pasada solo lee el archivo mapeado.
+    """
+    used = used_labels(chunks())
+    buf = pa.BufferOutputStream()
+    writer: Optional[pq.ParquetWriter] = None
+    for chunk in chunks():
+        table = flatten_labels(chunk, used).rename_columns(headers)
+        if writer is None:
+            writer = pq.ParquetWriter(buf, table.schema, compression="snappy", use_dictionary=True)
+        writer.write_table(table)
+    if writer is None:
+        # Archivo sin casos: Parquet válido con las columnas, todas de texto
+        pq.write_table(pa.table({h: pa.array([], pa.string()) for h in headers}), buf)
+    else:
+        writer.close()
+    return buf.getvalue().to_pybytes()
+
+
+@st.cache_data(show_spinner=False)
+def build_parquet(file_hash: str, encoding: Optional[str], _file_bytes: bytes) -> bytes:
+    """SAV → Parquet en streaming; se cachean los bytes generados."""
+    headers, _ = read_sav_metadata(file_hash, encoding, _file_bytes)
+    cache_key = disk_cache_key(file_hash, encoding)
+    return to_parquet_bytes(headers, partial(iter_labelled, cache_key, encoding, _file_bytes))
+
+
+@st.cache_data(show_spinner=False)
+def build_excel(
+    file_hash: str,
+    sheet_name: str,
+    compress: bool,
+    encoding: Optional[str],
+    _file_bytes: bytes,
+    inline_strings: bool = False,
+) -> bytes:
+    """SAV → Excel en streaming; se cachean los bytes del Excel generado, así los reruns no lo vuelven a serializar."""
+    headers, _ = read_sav_metadata(file_hash, encoding, _file_bytes)
+    chunks = iter_labelled(disk_cache_key(file_hash, encoding), encoding, _file_bytes)
+    return to_excel_bytes(headers, chunks, sheet_name, compress, use_inline_strings=inline_strings)
 
 # ======================
 # UI – Streamlit
 # ======================
 
+@st.fragment
+def download_section(
+    file_hash: str,
+    file_name: str,
+    data_bytes: bytes,
+    texts: Dict[str, str],
+    fast_excel: bool,
+    encoding: Optional[str],
+    inline_strings: bool,
+) -> None:
+    """Botones de descarga; como fragmento, pulsarlos no vuelve a ejecutar el script completo.
+
+    Los archivos se generan solo al pulsar (data como callable) y quedan cacheados por file_hash.
+    """
+    st.download_button(
+        label=texts["download"],
+        data=partial(
+            build_excel, file_hash, texts["sheetname"], not fast_excel, encoding, data_bytes, inline_strings
+        ),
+        file_name=Path(file_name).with_suffix('.xlsx').name,
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        use_container_width=True,
+    )
+    st.download_button(
+        label=texts["download_parquet"],
+        data=partial(build_parquet, file_hash, encoding, data_bytes),
+        file_name=Path(file_name).with_suffix('.parquet').name,
+        mime="application/octet-stream",
+        use_container_width=True,
+    )
+
+
 def main():
     st.set_page_config(
         page_title="SPSS → Excel",
@@ -150,6 +822,21 @@ def main():
             st.session_state.lang = "en" if st.session_state.lang == "es" else "es"
         texts = TEXTS[st.session_state.lang]
 
+        show_preview = st.toggle(texts["preview"], value=False, key="preview_toggle")
+        preview_rows = st.slider(texts["preview_rows"], min_value=5, max_value=100, value=30, step=5)
+
+        fast_excel = st.toggle(texts["fast_excel"], value=False, key="fast_excel_toggle", help=texts["fast_excel_help"])
+        inline_strings = st.toggle(
+            texts["inline_strings"], value=False, key="inline_strings_toggle", help=texts["inline_strings_help"]
+        )
+        encoding = st.selectbox(
+            texts["encoding"],
+            ENCODINGS,
+            format_func=lambda enc: enc or texts["encoding_auto"],
+            key="encoding_select",
+            help=texts["encoding_help"],
+        )
+
         st.info(texts["tips"])
 
     texts = TEXTS[st.session_state.lang]
@@ -166,35 +853,33 @@ def main():
     with st.status(texts["load_status"], expanded=False) as status:
         try:
             data_bytes = uploaded.getvalue()
-            rows, headers = process_sav(data_bytes)
+            file_hash = upload_digest(uploaded)
+            headers, n_rows = read_sav_metadata(file_hash, encoding, data_bytes)
             status.update(label=texts["success_load"], state="complete")
         except Exception as e:
             status.update(label=f"{texts['error_load']}: {e}", state="error")
             st.stop()
 
-    # Info del archivo
+    # Info del archivo; algunos SAV no declaran el número de casos (ncases = -1)
+    rows_text = f"{n_rows:,}" if n_rows is not None else "?"
     cols = st.columns(3)
     with cols[0]:
         st.metric("Columns", len(headers))
     with cols[1]:
-        st.metric("Rows", len(rows))
+        st.metric("Rows", rows_text)
     with cols[2]:
         st.metric("Size", f"{uploaded.size/1024/1024:.2f} MB")
 
-    st.markdown(texts["file_info"].format(name=uploaded.name, rows=len(rows), cols=len(headers)))
+    st.markdown(texts["file_info"].format(name=uploaded.name, rows=rows_text, cols=len(headers)))
 
-    with st.spinner(texts["saving"]):
-        excel_bytes = to_excel_bytes(headers, rows, texts["sheetname"])
+    if n_rows is not None and n_rows >= EXCEL_MAX_ROWS:
+        st.warning(texts["excel_limit"].format(max=EXCEL_MAX_ROWS - 1))
 
-    st.success(texts["success_save"], icon="✅")
-    st.download_button(
-        label=texts["download"],
-        data=excel_bytes,
-        file_name=Path(uploaded.name).with_suffix('.xlsx').name,
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        use_container_width=True,
-    )
+    if show_preview:
+        # La tabla Arrow va directo a st.dataframe, sin pasar por pandas
+        st.dataframe(read_sav_preview(file_hash, preview_rows, encoding, data_bytes), use_container_width=True)
 
+    download_section(file_hash, uploaded.name, data_bytes, texts, fast_excel, encoding, inline_strings)
 
 if __name__ == "__main__":
     main()